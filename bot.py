@@ -1,16 +1,24 @@
-import json
+import asyncio
+import functools
 import logging
 import os
+import queue
+import re
 import sqlite3
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
 from datetime import time as dt_time
 from datetime import timedelta
+from typing import Literal
 
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
+from pydantic import BaseModel
 from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CallbackContext,
     CommandHandler,
@@ -34,7 +42,19 @@ if GROUP_CHAT_ID is None:
 
 BOT_USERNAME = os.getenv("BOT_USERNAME", "tenskee_bot")
 
+_MENTION_RE = re.compile(
+    rf"@{re.escape(BOT_USERNAME.replace('_bot', ''))}(?:_bot)?\b", re.IGNORECASE
+)
+
+# Matches the summon phrase, e.g. "@tenskee_bot save us" or "Tenskee save us"
+_INVOKE_RE = re.compile(
+    rf"(?:@?{re.escape(BOT_USERNAME.replace('_bot', ''))}(?:_bot)?\s+(?:tenskee\s+)?"
+    r"|tenskee\s+)save\s+us",
+    re.IGNORECASE,
+)
+
 client = genai.Client(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = "gemini-2.0-flash"
 
 if os.getenv("RENDER"):
     DB_FILE = "/app/data/class_data.db"
@@ -46,49 +66,169 @@ else:
     DB_FILE = os.path.join(DATA_DIR, "class_data.db")
     print(f"[DB] Using local path: {DB_FILE}")
 
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-cursor = conn.cursor()
 
-cursor.execute(
+def _connect():
+    c = sqlite3.connect(
+        DB_FILE, check_same_thread=False, cached_statements=256, isolation_level=None
+    )
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA mmap_size=134217728")
+    c.execute("PRAGMA cache_size=-20000")
+    return c
+
+
+# One connection for writes; reads use a small pool so they can run on WAL
+# snapshots in parallel instead of queueing behind the writer.
+_write_conn = _connect()
+journal_mode = _write_conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+# WAL is refused on some network mounts, so confirm what SQLite actually gave us
+print(f"[DB] journal_mode={journal_mode}")
+
+# The connection runs in autocommit mode, so the schema is wrapped in an
+# explicit BEGIN/COMMIT to pay for a single fsync.
+_write_conn.executescript(
     """
+BEGIN;
+
 CREATE TABLE IF NOT EXISTS assignments (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     task TEXT NOT NULL,
     due DATE NOT NULL
-)
-"""
-)
+);
 
-cursor.execute(
-    """
 CREATE TABLE IF NOT EXISTS timetable (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     day TEXT NOT NULL UNIQUE,
     schedule TEXT NOT NULL
-)
-"""
-)
+);
 
-cursor.execute(
-    """
 CREATE TABLE IF NOT EXISTS events (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     type TEXT,                    -- exam, test, quiz, presentation, meeting, etc.
     title TEXT NOT NULL,
     date DATE NOT NULL,
     notes TEXT
-)
+);
+
+CREATE INDEX IF NOT EXISTS idx_assignments_due ON assignments(due);
+CREATE INDEX IF NOT EXISTS idx_events_date ON events(date);
+
+COMMIT;
 """
 )
-conn.commit()
 
 
-async def parse_message(text: str) -> dict:
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    prompt = f"""
+# Statements are kept as module-level constants so every call hands the same
+# string to sqlite3's statement cache.
+SQL_INSERT_ASSIGN = "INSERT INTO assignments (task, due) VALUES (?, ?)"
+SQL_UPSERT_TIMETABLE = "INSERT OR REPLACE INTO timetable (day, schedule) VALUES (?, ?)"
+SQL_LIST_ASSIGN = "SELECT task, due FROM assignments ORDER BY due"
+SQL_INSERT_EVENT = "INSERT INTO events (type, title, date, notes) VALUES (?, ?, ?, ?)"
+SQL_LIST_EVENTS = """
+SELECT type, title, date, notes FROM events
+WHERE date >= ?
+ORDER BY date
+LIMIT 10
+"""
+SQL_UPCOMING = """
+SELECT 'a' AS kind, task AS a, due AS b, NULL AS c, NULL AS d,
+       CAST(julianday(due) - julianday(?) AS INTEGER) AS days_left
+FROM assignments
+WHERE due BETWEEN ? AND date(?, '+7 days')
+UNION ALL
+SELECT 'e', title, date, type, notes,
+       CAST(julianday(date) - julianday(?) AS INTEGER)
+FROM events
+WHERE date BETWEEN ? AND date(?, '+14 days')
+UNION ALL
+SELECT 't', schedule, NULL, NULL, NULL, NULL FROM timetable
+WHERE day = ?
+ORDER BY kind, b
+"""
+SQL_REMINDERS = """
+SELECT 1 AS ord, 'due_today' AS kind, task AS a, NULL AS b, NULL AS c
+FROM assignments WHERE due = ?
+UNION ALL
+SELECT 2, 'due_tmrw', task, NULL, NULL FROM assignments WHERE due = ?
+UNION ALL
+SELECT 3, 'evt_today', title, type, notes FROM events WHERE date = ?
+UNION ALL
+SELECT 4, 'sched', schedule, NULL, NULL FROM timetable WHERE day = ?
+ORDER BY ord
+"""
+
+_TAGS = {0: "TODAY", 1: "Tomorrow"}
+
+
+# Date strings only change once a day, so they are memoized per calendar day
+@functools.lru_cache(maxsize=4)
+def _day_ctx(ord_day):
+    d = date.fromordinal(ord_day)
+    tomorrow = d + timedelta(days=1)
+    return (
+        d.isoformat(),
+        d.strftime("%A"),
+        tomorrow.strftime("%A"),
+        tomorrow.isoformat(),
+    )
+
+
+_READ_POOL_SIZE = 4
+_read_pool: queue.Queue = queue.Queue()
+for _ in range(_READ_POOL_SIZE):
+    _read_conn = _connect()
+    _read_conn.execute("PRAGMA query_only=1")
+    _read_pool.put(_read_conn)
+
+
+@contextmanager
+def reader():
+    c = _read_pool.get()
+    try:
+        yield c
+    finally:
+        _read_pool.put(c)
+
+
+# sqlite3 calls block, so handlers run them on a worker thread to keep the
+# event loop free; writes are serialized since they share one connection.
+_write_lock = asyncio.Lock()
+
+
+def _fetchall(sql, params):
+    with reader() as c:
+        return c.execute(sql, params).fetchall()
+
+
+async def db_read(sql, params=()):
+    return await asyncio.to_thread(_fetchall, sql, params)
+
+
+async def db_write(sql, params):
+    async with _write_lock:
+        await asyncio.to_thread(_write_conn.execute, sql, params)
+
+
+def _insert_assignments(rows):
+    _write_conn.execute("BEGIN")
+    try:
+        _write_conn.executemany(SQL_INSERT_ASSIGN, rows)
+        _write_conn.execute("COMMIT")
+    except Exception:
+        _write_conn.execute("ROLLBACK")
+        raise
+
+
+# One transaction for the whole batch instead of one commit per row
+async def bulk_add_assignments(rows):
+    async with _write_lock:
+        await asyncio.to_thread(_insert_assignments, rows)
+
+
+_PROMPT_TMPL = """
 You are Tenskee, a magical class group assistant for students.
-Output ONLY valid JSON. No explanation. No markdown.
-Allowed formats:
+Reply with one of these actions, leaving out fields the action does not use:
 {{"action": "add_assignment", "task": "string", "due": "YYYY-MM-DD"}}
 {{"action": "add_timetable", "day": "Monday", "schedule": "string"}}
 {{"action": "list_assignments"}}
@@ -96,30 +236,104 @@ Allowed formats:
 {{"action": "list_events"}}
 {{"action": "unknown"}}
 Convert relative dates properly (tomorrow, next Friday, in 2 weeks → absolute YYYY-MM-DD).
-Today is {today_str}
+Today is {today}
 Message:
 {text}
 """
+
+
+class ParsedAction(BaseModel):
+    action: Literal[
+        "add_assignment",
+        "add_timetable",
+        "list_assignments",
+        "add_event",
+        "list_events",
+        "unknown",
+    ]
+    task: str | None = None
+    due: str | None = None
+    day: str | None = None
+    schedule: str | None = None
+    type: str | None = None
+    title: str | None = None
+    date: str | None = None
+    notes: str | None = None
+
+
+_GEN_CONFIG = types.GenerateContentConfig(
+    temperature=0.1,
+    max_output_tokens=300,
+    response_mime_type="application/json",
+    response_schema=ParsedAction,
+)
+
+_PARSE_CACHE_SIZE = 1024
+_parse_cache: OrderedDict = OrderedDict()
+_SPACES_RE = re.compile(r"\s+")
+
+
+# Punctuation is kept because it carries dates and times ("3/1", "9:30")
+def _cache_key(today_str: str, text: str) -> tuple:
+    return today_str, _SPACES_RE.sub(" ", text).strip().casefold()
+
+
+async def parse_message(text: str) -> dict:
+    today_str = _day_ctx(date.today().toordinal())[0]
+    key = _cache_key(today_str, text)
+    cached = _parse_cache.get(key)
+    # add_* results echo the sender's wording, so only reuse them verbatim
+    if cached is not None and (
+        cached[0] == text or not cached[1]["action"].startswith("add_")
+    ):
+        _parse_cache.move_to_end(key)
+        return dict(cached[1])
+
+    prompt = _PROMPT_TMPL.format(today=today_str, text=text)
     try:
         response = client.models.generate_content(
-            model="gemini-2.0-flash",
+            model=GEMINI_MODEL,
             contents=prompt,
-            config=types.GenerateContentConfig(
-                temperature=0.1,
-                max_output_tokens=300,
-            ),
+            config=_GEN_CONFIG,
         )
-        if not response or not response.text:
+        if not response or response.parsed is None:
             raise ValueError("Empty response from Gemini")
-        raw = response.text.strip()
-        cleaned = raw.replace("```json", "").replace("```", "").strip()
-        parsed = json.loads(cleaned)
-        return parsed
+        parsed = response.parsed.model_dump(exclude_none=True)
+        _parse_cache[key] = (text, parsed)
+        _parse_cache.move_to_end(key)
+        if len(_parse_cache) > _PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+        return dict(parsed)
     except Exception as e:
         logging.error(f"Gemini failed: {str(e)}")
         return {"action": "llm_down", "error": str(e)}
 
 
+# Commands simple enough to recognise without asking Gemini
+_LIST_ASSIGN_RE = re.compile(r"\s*(?:@\w+\s+)?list\s+assignments?\s*$", re.IGNORECASE)
+_LIST_EVENTS_RE = re.compile(r"\s*(?:@\w+\s+)?list\s+events?\s*$", re.IGNORECASE)
+_ADD_TIMETABLE_RE = re.compile(
+    r"\s*(?:@\w+\s+)?add\s+timetable\s+"
+    r"(monday|tuesday|wednesday|thursday|friday|saturday|sunday)\s+(\S.*?)\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def _fast_parse(text: str):
+    if _LIST_ASSIGN_RE.match(text):
+        return {"action": "list_assignments"}
+    if _LIST_EVENTS_RE.match(text):
+        return {"action": "list_events"}
+    match = _ADD_TIMETABLE_RE.match(text)
+    if match:
+        return {
+            "action": "add_timetable",
+            "day": match.group(1).capitalize(),
+            "schedule": match.group(2),
+        }
+    return None
+
+
 async def start(update: Update, _: CallbackContext):
     user = update.effective_user
     is_group = update.effective_chat.type in ["group", "supergroup"]
@@ -160,29 +374,16 @@ async def start(update: Update, _: CallbackContext):
 
 async def handle_message(update: Update, _: CallbackContext):
     message_text = update.message.text or ""
-    lower_text = message_text.lower()
-
-    mentioned = (
-        f"@{BOT_USERNAME.lower()}" in lower_text
-        or f"@{BOT_USERNAME.lower().replace('_bot','')}" in lower_text
-    )
-
-    if not mentioned:
+    if not _MENTION_RE.search(message_text):
         return
 
-    cleaned_text = message_text
-    for phrase in [
-        "Tenskee save us",
-        "tenskee save us",
-        f"@{BOT_USERNAME} save us",
-        f"@{BOT_USERNAME.replace('_bot','')} save us",
-        f"@{BOT_USERNAME} Tenskee save us",
-        f"@{BOT_USERNAME.replace('_bot','')} Tenskee save us",
-    ]:
-        cleaned_text = cleaned_text.replace(phrase, "", 1).strip()
-        cleaned_text = cleaned_text.replace(phrase.lower(), "", 1).strip()
+    today_iso, _, tomorrow_dow, _ = _day_ctx(date.today().toordinal())
 
-    cleaned_text = cleaned_text.strip()
+    cleaned_text = _INVOKE_RE.sub("", message_text, count=1).strip()
+    # A bare mention, or leftovers like emoji, carry no command; skip Gemini
+    command = _MENTION_RE.sub("", cleaned_text).strip()
+    if len(command) < 3 or not any(c.isalpha() for c in command):
+        cleaned_text = ""
 
     reply_prefix = "Tenskee hears your desperate call… ✨ I bring salvation!\n\n"
 
@@ -190,7 +391,7 @@ async def handle_message(update: Update, _: CallbackContext):
     llm_failed = False
 
     if cleaned_text:
-        parsed = await parse_message(cleaned_text)
+        parsed = _fast_parse(cleaned_text) or await parse_message(cleaned_text)
         if parsed.get("action") == "llm_down":
             llm_failed = True
             await update.message.reply_text(
@@ -201,11 +402,7 @@ async def handle_message(update: Update, _: CallbackContext):
 
     if not llm_failed and cleaned_text:
         if parsed["action"] == "add_assignment":
-            cursor.execute(
-                "INSERT INTO assignments (task, due) VALUES (?, ?)",
-                (parsed["task"], parsed["due"]),
-            )
-            conn.commit()
+            await db_write(SQL_INSERT_ASSIGN, (parsed["task"], parsed["due"]))
             await update.message.reply_text(
                 reply_prefix
                 + f"Assignment sealed: {parsed['task']} due {parsed['due']}"
@@ -213,19 +410,14 @@ async def handle_message(update: Update, _: CallbackContext):
             return
 
         elif parsed["action"] == "add_timetable":
-            cursor.execute(
-                "INSERT OR REPLACE INTO timetable (day, schedule) VALUES (?, ?)",
-                (parsed["day"], parsed["schedule"]),
-            )
-            conn.commit()
+            await db_write(SQL_UPSERT_TIMETABLE, (parsed["day"], parsed["schedule"]))
             await update.message.reply_text(
                 reply_prefix + f"Timetable inscribed for {parsed['day']}"
             )
             return
 
         elif parsed["action"] == "list_assignments":
-            cursor.execute("SELECT task, due FROM assignments ORDER BY due")
-            assignments = cursor.fetchall()
+            assignments = await db_read(SQL_LIST_ASSIGN)
             if not assignments:
                 await update.message.reply_text(
                     reply_prefix + "No assignments recorded yet."
@@ -238,8 +430,8 @@ async def handle_message(update: Update, _: CallbackContext):
             return
 
         elif parsed["action"] == "add_event":
-            cursor.execute(
-                "INSERT INTO events (type, title, date, notes) VALUES (?, ?, ?, ?)",
+            await db_write(
+                SQL_INSERT_EVENT,
                 (
                     parsed.get("type") or None,
                     parsed["title"],
@@ -247,7 +439,6 @@ async def handle_message(update: Update, _: CallbackContext):
                     parsed.get("notes") or None,
                 ),
             )
-            conn.commit()
             type_str = f" ({parsed['type']})" if parsed.get("type") else ""
             notes_str = f" – {parsed['notes']}" if parsed.get("notes") else ""
             await update.message.reply_text(
@@ -257,66 +448,39 @@ async def handle_message(update: Update, _: CallbackContext):
             return
 
         elif parsed["action"] == "list_events":
-            today = datetime.now().date()
-            cursor.execute(
-                """
-                SELECT type, title, date, notes FROM events
-                WHERE date >= ?
-                ORDER BY date
-                LIMIT 10
-                """,
-                (today.strftime("%Y-%m-%d"),),
-            )
-            events = cursor.fetchall()
+            events = await db_read(SQL_LIST_EVENTS, (today_iso,))
             if not events:
                 await update.message.reply_text(
                     reply_prefix + "No upcoming events recorded."
                 )
             else:
-                msg = "Upcoming events:\n"
-                for typ, title, date, notes in events:
+                parts = ["Upcoming events:"]
+                for typ, title, event_date, notes in events:
                     type_str = f"[{typ}] " if typ else ""
                     notes_str = f" – {notes}" if notes else ""
-                    msg += f"- {type_str}{title} ({date}){notes_str}\n"
+                    parts.append(f"- {type_str}{title} ({event_date}){notes_str}")
+                msg = "\n".join(parts)
                 await update.message.reply_text(reply_prefix + msg)
             return
 
-    today = datetime.now().date()
     upcoming = []
 
-    cursor.execute(
-        "SELECT task, due FROM assignments WHERE due >= ? AND due <= date(?, '+7 days') ORDER BY due",
-        (today.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")),
-    )
-    for task, due in cursor.fetchall():
-        days_left = (datetime.strptime(due, "%Y-%m-%d").date() - today).days
-        tag = (
-            "TODAY"
-            if days_left == 0
-            else "Tomorrow" if days_left == 1 else f"In {days_left} days"
-        )
-        upcoming.append(f"Assignment {tag}: {task}")
+    rows = await db_read(SQL_UPCOMING, (today_iso,) * 6 + (tomorrow_dow,))
+    sched = None
+    for kind, a, b, c, d, days_left in rows:
+        if kind == "t":
+            sched = a
+            continue
+        tag = _TAGS.get(days_left) or f"In {days_left} days"
+        if kind == "a":
+            upcoming.append(f"Assignment {tag}: {a}")
+        else:
+            type_str = f"[{c.upper()}] " if c else ""
+            notes_str = f" – {d}" if d else ""
+            upcoming.append(f"Event {type_str}{tag}: {a}{notes_str}")
 
-    cursor.execute(
-        "SELECT type, title, date, notes FROM events WHERE date >= ? AND date <= date(?, '+14 days') ORDER BY date",
-        (today.strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")),
-    )
-    for typ, title, date, notes in cursor.fetchall():
-        days_left = (datetime.strptime(date, "%Y-%m-%d").date() - today).days
-        tag = (
-            "TODAY"
-            if days_left == 0
-            else "Tomorrow" if days_left == 1 else f"In {days_left} days"
-        )
-        type_str = f"[{typ.upper()}] " if typ else ""
-        notes_str = f" – {notes}" if notes else ""
-        upcoming.append(f"Event {type_str}{tag}: {title}{notes_str}")
-
-    tomorrow_str = (today + timedelta(days=1)).strftime("%A")
-    cursor.execute("SELECT schedule FROM timetable WHERE day = ?", (tomorrow_str,))
-    sched = cursor.fetchone()
     if sched:
-        upcoming.append(f"Tomorrow's classes: {sched[0]}")
+        upcoming.append(f"Tomorrow's classes: {sched}")
 
     if upcoming:
         response = reply_prefix + "These trials approach:\n" + "\n".join(upcoming)
@@ -327,36 +491,21 @@ async def handle_message(update: Update, _: CallbackContext):
 
 
 async def send_reminders_job(context: CallbackContext):
-    today = datetime.now().date()
+    today_iso, today_dow, _, tomorrow_iso = _day_ctx(date.today().toordinal())
     reminders = []
 
-    cursor.execute(
-        "SELECT task FROM assignments WHERE due = ?",
-        (today.strftime("%Y-%m-%d"),),
-    )
-    for (task,) in cursor.fetchall():
-        reminders.append(f"Due today — brace yourselves: {task}")
-
-    tomorrow_str = (today + timedelta(days=1)).strftime("%Y-%m-%d")
-    cursor.execute("SELECT task FROM assignments WHERE due = ?", (tomorrow_str,))
-    for (task,) in cursor.fetchall():
-        reminders.append(f"Due tomorrow: {task}")
-
-    cursor.execute(
-        "SELECT type, title, notes FROM events WHERE date = ?",
-        (today.strftime("%Y-%m-%d"),),
-    )
-    for typ, title, notes in cursor.fetchall():
-        type_str = f"[{typ.upper()}] " if typ else ""
-        notes_str = f" – {notes}" if notes else ""
-        reminders.append(f"Today: {type_str}{title}{notes_str}")
-
-    cursor.execute(
-        "SELECT schedule FROM timetable WHERE day = ?", (today.strftime("%A"),)
-    )
-    schedule = cursor.fetchone()
-    if schedule:
-        reminders.append(f"Today's path: {schedule[0]}")
+    rows = await db_read(SQL_REMINDERS, (today_iso, tomorrow_iso, today_iso, today_dow))
+    for _, kind, a, b, c in rows:
+        if kind == "due_today":
+            reminders.append(f"Due today — brace yourselves: {a}")
+        elif kind == "due_tmrw":
+            reminders.append(f"Due tomorrow: {a}")
+        elif kind == "evt_today":
+            type_str = f"[{b.upper()}] " if b else ""
+            notes_str = f" – {c}" if c else ""
+            reminders.append(f"Today: {type_str}{a}{notes_str}")
+        else:
+            reminders.append(f"Today's path: {a}")
 
     if reminders:
         try:
@@ -372,7 +521,14 @@ async def send_reminders_job(context: CallbackContext):
 # Main
 logging.basicConfig(level=logging.INFO)
 
-app = ApplicationBuilder().token(TOKEN).build()
+# Telegram allows about 20 messages per minute in a group; throttle every
+# outgoing call up front instead of riding out 429 retries.
+app = (
+    ApplicationBuilder()
+    .token(TOKEN)
+    .rate_limiter(AIORateLimiter(group_max_rate=20, group_time_period=60))
+    .build()
+)
 
 # /start command
 app.add_handler(CommandHandler("start", start))
@@ -388,3 +544,13 @@ app.job_queue.run_daily(
 
 print("Tenskee is listening...")
 app.run_polling()
+
+# PRAGMA optimize only analyzes tables queried on the same connection, and
+# all SELECTs run on the readers, so each reader refreshes the planner stats
+# for what it saw before closing.
+while not _read_pool.empty():
+    _read_conn = _read_pool.get_nowait()
+    _read_conn.execute("PRAGMA query_only=0")
+    _read_conn.execute("PRAGMA optimize")
+    _read_conn.close()
+_write_conn.close()